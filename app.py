@@ -1,30 +1,114 @@
-from datetime import date, datetime, timedelta
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
 from decimal import Decimal
-from flask import Flask, render_template, request, redirect, url_for, flash
+from functools import lru_cache, wraps
+import time
+from itertools import accumulate
+from operator import itemgetter
+from uuid import uuid4
+import click
+from flask import (Flask, render_template, request, redirect, url_for, flash, abort, g,
+                   has_request_context, make_response, session)
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import case, cast, column, delete, event, func, insert, text, tuple_, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import raiseload, selectinload
+
+try:
+    import orjson  # opcional: serializa más rápido los datos de los charts
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///presupuesto.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool estable: cada conexión se abre (y recibe sus PRAGMA) una vez y se reutiliza entre peticiones.
+# SQLAlchemy ya usa check_same_thread=False con SQLite en fichero; pre_ping sería un SELECT extra por checkout.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'pool_pre_ping': False}
 app.config['SECRET_KEY'] = 'dev'
+# Plantillas compiladas a bytecode en el directorio temporal del sistema: cada proceso nuevo
+# (reinicio o worker) las carga sin recompilar; la clave incluye el checksum del fuente.
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache()}
+
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """|tojson y jsonify con orjson; lo que orjson no admite pasa al json de la stdlib."""
+        def dumps(self, obj, **kwargs):
+            if set(kwargs) - {'sort_keys'}:
+                return super().dumps(obj, **kwargs)
+            option = orjson.OPT_PASSTHROUGH_DATETIME  # fechas con el mismo formato que Flask
+            if kwargs.get('sort_keys', self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode()
+            except TypeError:  # p. ej. claves que no son str
+                return super().dumps(obj, **kwargs)
+
+        def loads(self, s, **kwargs):
+            return super().loads(s, **kwargs) if kwargs else orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
 
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    """Ajustes de cada conexión SQLite nueva (el pool las reutiliza)."""
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')    # lectores concurrentes con una escritura
+    cur.execute('PRAGMA synchronous=NORMAL')  # con WAL basta un fsync por checkpoint
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute('PRAGMA mmap_size=268435456')
+    cur.execute('PRAGMA cache_size=-20000')   # ~20 MB de caché de páginas
+    cur.execute('PRAGMA foreign_keys=ON')
+    cur.close()
+
 # --------- CONSTANTES ---------
 CYCLE_START_DAY = 25  # ciclo del 25 al 24
+TX_PER_PAGE = 50      # filas por página en el listado de transacciones
+SNAPSHOT_GRACE_DAYS = 3    # días tras el fin de un ciclo antes de congelar sus agregados
+CATALOG_TTL = 60           # segundos que un worker reutiliza cuentas/categorías sin releerlas
 
 # --------- MODELOS ---------
 class Account(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(80), nullable=False, unique=True)
     saldo_inicial = db.Column(db.Numeric(12, 2), default=0)
+    transactions = db.relationship('Transaction', back_populates='account', lazy=True,
+                                   passive_deletes=True)  # el borrado ya comprueba que no hay hijas
 
 class Category(db.Model):
+    __table_args__ = (
+        db.CheckConstraint("tipo IN ('ingreso', 'gasto')", name='ck_category_tipo'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(80), nullable=False, unique=True)
-    tipo = db.Column(db.String(10), nullable=False)  # 'ingreso' | 'gasto'
+    # validate_strings hace que Enum rechace otros valores antes de enviarlos; el CHECK de arriba
+    # solo existe en BDs nuevas (create_all no altera tablas), las antiguas las normaliza init_db
+    tipo = db.Column(db.Enum('ingreso', 'gasto', name='tipo_categoria', native_enum=False,
+                             create_constraint=False, validate_strings=True, length=10),
+                     nullable=False)
+    transactions = db.relationship('Transaction', back_populates='category', lazy=True,
+                                   passive_deletes=True)  # el borrado ya comprueba que no hay hijas
+
+# mismo orden que los listados (tipo DESC, nombre): SQLite lo recorre sin ordenar
+db.Index('ix_cat_tipo_nombre', Category.tipo.desc(), Category.nombre)
 
 class Transaction(db.Model):
+    __table_args__ = (
+        # agregado del ciclo por categoría (resumen) sin leer la tabla
+        db.Index('ix_tx_fecha_cat', 'fecha', 'category_id', 'importe'),
+        # listado paginado por cursor: recorre (fecha, id) en orden y para en el LIMIT
+        db.Index('ix_tx_fecha_id', 'fecha', 'id'),
+        db.Index('ix_tx_account_fecha', 'account_id', 'fecha'),
+        db.Index('ix_tx_category_fecha', 'category_id', 'fecha'),
+        # cubre el saldo por cuenta de resumen sin leer la tabla
+        db.Index('ix_tx_account_cat_importe', 'account_id', 'category_id', 'importe'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     fecha = db.Column(db.Date, nullable=False)
     concepto = db.Column(db.String(120), nullable=False)
@@ -33,17 +117,24 @@ class Transaction(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     nota = db.Column(db.Text)
 
-    account = db.relationship('Account', backref=db.backref('transactions', lazy=True))
-    category = db.relationship('Category', backref=db.backref('transactions', lazy=True))
+    account = db.relationship('Account', back_populates='transactions', lazy='select')
+    category = db.relationship('Category', back_populates='transactions', lazy='select')
 
-    @property
+    @hybrid_property
     def signed_amount(self) -> Decimal:
-        if self.category and (self.category.tipo or '').strip().lower() == 'ingreso':
-            return Decimal(self.importe or 0)
-        return -Decimal(self.importe or 0)
+        importe = self.importe or Decimal('0')  # Numeric ya devuelve Decimal
+        return importe if self.category and self.category.tipo == 'ingreso' else -importe
+
+    @signed_amount.expression
+    def signed_amount(cls):
+        # en SQL necesita un join con Category
+        return case((Category.tipo == 'ingreso', cls.importe), else_=-cls.importe)
 
 # ---- Objetivos de ahorro ----
 class Goal(db.Model):
+    __table_args__ = (
+        db.Index('ix_goal_fecha_limite', 'fecha_limite'),  # orden de /objetivos
+    )
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(120), nullable=False)
     monto_objetivo = db.Column(db.Numeric(12, 2), nullable=False)
@@ -51,10 +142,6 @@ class Goal(db.Model):
     nota = db.Column(db.Text)
     aportes = db.relationship('GoalContribution', backref='goal', cascade='all, delete-orphan')
 
-    @property
-    def total_aportado(self) -> Decimal:
-        return sum((a.monto or Decimal('0')) for a in self.aportes) or Decimal('0')
-
     @property
     def porcentaje(self) -> float:
         if not self.monto_objetivo or Decimal(self.monto_objetivo) == 0:
@@ -62,12 +149,23 @@ class Goal(db.Model):
         return float((self.total_aportado / Decimal(self.monto_objetivo)) * 100)
 
 class GoalContribution(db.Model):
+    __table_args__ = (
+        db.Index('ix_goalcontrib_goal', 'goal_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     goal_id = db.Column(db.Integer, db.ForeignKey('goal.id'), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
     monto = db.Column(db.Numeric(12, 2), nullable=False)
     comentario = db.Column(db.String(200))
 
+# Total aportado calculado por SQLite en la misma SELECT del objetivo
+Goal.total_aportado = db.column_property(
+    db.select(func.coalesce(func.sum(GoalContribution.monto), 0))
+    .where(GoalContribution.goal_id == Goal.id)
+    .correlate_except(GoalContribution)
+    .scalar_subquery()
+)
+
 # ---- Presupuesto por ciclo ----
 class Budget(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -83,16 +181,109 @@ class BudgetLine(db.Model):
     amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)
     category = db.relationship('Category')
 
+# ---- Agregados de ciclos cerrados ----
+class CycleSummary(db.Model):
+    cycle_start = db.Column(db.Date, primary_key=True)  # inicio del ciclo (25)
+    ingresos = db.Column(db.Float, nullable=False, default=0)
+    gastos = db.Column(db.Float, nullable=False, default=0)
+
+class CycleAggregate(db.Model):
+    cycle_start = db.Column(db.Date, db.ForeignKey('cycle_summary.cycle_start'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0)  # mismo float que el agregado en vivo
+
+# ---- Versión de los datos del resumen (compartida entre procesos) ----
+class DataVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # una sola fila, id = 1
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # --------- INIT / SEED ---------
-@app.before_request
-def _startup():
+def create_missing_indexes():
+    """create_all() solo crea índices junto con su tabla; esto los añade a bases ya existentes."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+# Índice FTS5 (tokenizador trigram) sobre Transaction.concepto. Con trigram, LIKE '%texto%'
+# sobre tx_fts usa el índice y conserva la semántica del ilike original.
+TX_FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS tx_fts_ai AFTER INSERT ON "transaction" BEGIN
+         INSERT INTO tx_fts(rowid, concepto) VALUES (new.id, new.concepto);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS tx_fts_ad AFTER DELETE ON "transaction" BEGIN
+         INSERT INTO tx_fts(tx_fts, rowid, concepto) VALUES ('delete', old.id, old.concepto);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS tx_fts_au AFTER UPDATE OF concepto ON "transaction" BEGIN
+         INSERT INTO tx_fts(tx_fts, rowid, concepto) VALUES ('delete', old.id, old.concepto);
+         INSERT INTO tx_fts(rowid, concepto) VALUES (new.id, new.concepto);
+       END""",
+]
+tx_fts_enabled = False
+
+def create_search_index():
+    """Crea tx_fts y sus triggers; si el SQLite no trae FTS5/trigram se sigue usando ilike."""
+    global tx_fts_enabled
+    existe = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tx_fts'")
+    ).first() is not None
+    try:
+        if not existe:
+            db.session.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS tx_fts USING fts5("
+                "concepto, content='transaction', content_rowid='id', tokenize='trigram')"
+            ))
+            db.session.execute(text("INSERT INTO tx_fts(tx_fts) VALUES ('rebuild')"))
+        for ddl in TX_FTS_TRIGGERS:
+            db.session.execute(text(ddl))
+        db.session.commit()
+        tx_fts_enabled = True
+    except OperationalError as e:
+        db.session.rollback()
+        if 'locked' in str(e):
+            raise  # BD ocupada por otro worker: lo reintenta init_db(), no es falta de FTS5
+        tx_fts_enabled = False
+
+def normalize_category_tipos():
+    """BDs creadas sin el CHECK pueden traer 'Ingreso ', 'GASTO'...: se dejan en minúscula y sin
+    espacios, y lo que siga sin ser un tipo válido pasa a 'gasto' (como lo trata /resumen)."""
+    db.session.execute(text(
+        "UPDATE category SET tipo = CASE WHEN lower(trim(tipo)) = 'ingreso' THEN 'ingreso' "
+        "ELSE 'gasto' END WHERE tipo NOT IN ('ingreso', 'gasto')"
+    ))
+
+# Tablas que lee /resumen: cualquier INSERT/UPDATE/DELETE sobre ellas sube data_version.version
+# dentro de la misma transacción, sea cual sea el worker que escribe.
+DATA_VERSION_TABLES = ('transaction', 'account', 'category', 'budget', 'budget_line')
+
+def create_data_version():
+    """Siembra la fila de data_version y los triggers que la incrementan."""
+    db.session.execute(text("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)"))
+    for tabla in DATA_VERSION_TABLES:
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            db.session.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS dv_{tabla}_{evento.lower()} AFTER {evento} ON "{tabla}" '
+                f"BEGIN UPDATE data_version SET version = version + 1 WHERE id = 1; END"
+            ))
+
+INIT_DB_INTENTOS = 5
+
+def _init_db_once():
     db.create_all()
-    if Account.query.count() == 0:
+    create_missing_indexes()
+    create_search_index()
+    normalize_category_tipos()
+    create_data_version()
+    # las dos comprobaciones antes de añadir nada: la segunda no debe autovolcar la primera siembra
+    # (basta con saber si hay alguna fila: no hace falta contar la tabla)
+    sin_cuentas = db.session.query(Account.id).first() is None
+    sin_categorias = db.session.query(Category.id).first() is None
+    if sin_cuentas:
         db.session.add_all([
             Account(nombre='Banco', saldo_inicial=Decimal('0.00')),
             Account(nombre='Efectivo', saldo_inicial=Decimal('0.00')),
         ])
-    if Category.query.count() == 0:
+    if sin_categorias:
         db.session.add_all([
             Category(nombre='Salario', tipo='ingreso'),
             Category(nombre='Supermercado', tipo='gasto'),
@@ -102,20 +293,222 @@ def _startup():
         ])
     db.session.commit()
 
+def init_db():
+    """Crea tablas e índices que falten y siembra cuentas/categorías por defecto.
+
+    Con varios workers arrancando a la vez sobre una BD nueva, otro proceso puede crear la
+    misma tabla o índice, sembrar los mismos nombres únicos o tener la BD bloqueada entre la
+    comprobación y la escritura. Cada paso es idempotente, así que se reintenta desde cero
+    y el reintento ya ve el trabajo del otro.
+    """
+    for intento in range(INIT_DB_INTENTOS):
+        try:
+            _init_db_once()
+            return
+        except (OperationalError, IntegrityError):
+            db.session.rollback()
+            if intento == INIT_DB_INTENTOS - 1:
+                raise
+            time.sleep(0.1 * (intento + 1))
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crea las tablas e índices que falten."""
+    init_db()
+    click.echo('Base de datos inicializada')
+
+# Una sola vez al arrancar, no en cada petición
+with app.app_context():
+    init_db()
+
+# --------- DEBUG ---------
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if app.debug and has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _count_query)
+
+@app.context_processor
+def _debug_context():
+    # callable para que el pie cuente también las consultas lanzadas por la plantilla
+    return {'query_count': lambda: g.get('query_count', 0)}
+
 # --------- HELPERS ---------
+def no_autoflush(view):
+    """Para vistas de solo lectura: no hay cambios pendientes que volcar antes de cada consulta."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with db.session.no_autoflush:
+            return view(*args, **kwargs)
+    return wrapper
+
 def parse_date(s, default=None):
     try:
-        return datetime.strptime(s, "%Y-%m-%d").date()
+        return date.fromisoformat(s)  # parser en C; los <input type=date> envían YYYY-MM-DD
     except Exception:
         return default
 
+@lru_cache(maxsize=256)
+def _cycle_bounds_cached(n: int, start_day: int):
+    """(inicio_inclusivo, fin_exclusivo) del ciclo que empieza en el mes n = año*12 + (mes-1)."""
+    year, month0 = divmod(n, 12)
+    next_year, next_month0 = divmod(n + 1, 12)
+    return date(year, month0 + 1, start_day), date(next_year, next_month0 + 1, start_day)
+
 def cycle_bounds(ref: date, start_day: int = CYCLE_START_DAY):
     """(inicio_inclusivo, fin_exclusivo) del ciclo que contiene ref."""
-    start = date(ref.year, ref.month, start_day)
-    if ref < start:
-        start = date(start.year - 1, 12, start_day) if start.month == 1 else date(start.year, start.month - 1, start_day)
-    end = date(start.year + 1, 1, start_day) if start.month == 12 else date(start.year, start.month + 1, start_day)
-    return start, end
+    # antes del día de inicio, ref pertenece al ciclo que empezó el mes anterior
+    n = ref.year * 12 + ref.month - 1 - (ref.day < start_day)
+    return _cycle_bounds_cached(n, start_day)
+
+# --------- CACHÉ DE /resumen ---------
+# El resumen de un ciclo solo cambia cuando se escriben transacciones, cuentas,
+# categorías o presupuestos; los triggers de DATA_VERSION_TABLES suben entonces
+# data_version en la BD. Cada worker guarda su HTML junto a esa versión y lo
+# descarta en cuanto la de la BD es otra, aunque la escritura la hiciera otro proceso.
+_cache_epoch = uuid4().hex[:8]  # evita ETags repetidos entre reinicios
+_resumen_cache = OrderedDict()  # d1 -> (version, etag, html), del menos al más reciente
+RESUMEN_CACHE_MAX = 24  # ciclos guardados; ?y=&m= permite pedir cualquiera
+
+def current_data_version():
+    return db.session.query(DataVersion.version).filter(DataVersion.id == 1).scalar()
+
+# --------- CACHÉ DE CATÁLOGOS ---------
+# Cuentas y categorías para los desplegables: cambian muy poco, así que se
+# guardan como filas ligeras (no instancias ORM) hasta la próxima escritura
+# en /cuentas o /categorias, que llama a bump_catalog_version().
+# bump_catalog_version() solo avisa a su propio proceso: la clave incluye también
+# una ventana de CATALOG_TTL segundos para que los demás workers se pongan al día.
+_catalog_version = 0
+
+def bump_catalog_version():
+    global _catalog_version
+    _catalog_version += 1
+
+@lru_cache(maxsize=1)
+def _accounts_cached(version):
+    return tuple(db.session.query(Account.id, Account.nombre).order_by(Account.nombre).all())
+
+def list_categories():
+    """Filas (id, nombre, tipo) en el orden de los listados; el índice ix_cat_tipo_nombre lo cubre."""
+    return (db.session.query(Category.id, Category.nombre, Category.tipo)
+            .order_by(Category.tipo.desc(), Category.nombre).all())
+
+@lru_cache(maxsize=1)
+def _categories_cached(version):
+    return tuple(list_categories())
+
+@lru_cache(maxsize=1)
+def _gasto_categories_cached(version):
+    return tuple(c for c in _categories_cached(version) if c.tipo == 'gasto')  # ya por nombre
+
+def _catalog_key():
+    return _catalog_version, int(time.monotonic() // CATALOG_TTL)
+
+def get_accounts():
+    return _accounts_cached(_catalog_key())
+
+def get_categories():
+    return _categories_cached(_catalog_key())
+
+def get_gasto_categories():
+    return _gasto_categories_cached(_catalog_key())
+
+# --------- SNAPSHOTS DE CICLOS ---------
+# Los ciclos cerrados no cambian salvo que se escriba una transacción con fecha
+# dentro de ellos: sus totales por (categoría, día) se guardan una vez y el
+# resumen los lee de ahí. Cada escritura de transacciones descarta el snapshot
+# de los ciclos afectados con invalidate_cycle_snapshots().
+def cycle_closed(d2):
+    return date.today() - d2 >= timedelta(days=SNAPSHOT_GRACE_DAYS)
+
+def _live_cycle_rows(d1, d2):
+    """Una fila (category_id, nombre, tipo, fecha, total) por categoría y día del ciclo."""
+    return (db.session.query(Category.id, Category.nombre, Category.tipo,
+                             Transaction.fecha, func.sum(cast(Transaction.importe, db.Float)))
+            .join(Category, Transaction.category_id == Category.id)
+            .filter(Transaction.fecha >= d1, Transaction.fecha < d2)
+            .group_by(Category.id, Transaction.fecha)
+            .all())
+
+def snapshot_cycle(d1, d2, guardar_vacio=True):
+    """Calcula y guarda los agregados del ciclo; devuelve (CycleSummary o None si no se guardó, filas)."""
+    version = current_data_version()
+    filas = _live_cycle_rows(d1, d2)
+    if not filas and not guardar_vacio:
+        return None, filas
+    summary = CycleSummary(
+        cycle_start=d1,
+        ingresos=sum(total or 0.0 for _, _, tipo, _, total in filas if tipo == 'ingreso'),
+        gastos=sum(total or 0.0 for _, _, tipo, _, total in filas if tipo == 'gasto'))
+    db.session.add(summary)
+    db.session.flush()  # sin relación ORM: la fila padre debe existir antes que sus agregados
+    db.session.add_all(CycleAggregate(cycle_start=d1, category_id=cat_id, fecha=fecha, total=total or 0.0)
+                       for cat_id, _, _, fecha, total in filas)
+    db.session.commit()
+    # La lectura (autocommit) y el INSERT van en transacciones distintas: una escritura entre
+    # ambas no encontró snapshot que invalidar y este puede haber nacido viejo. Ante cualquier
+    # cambio de data_version se descarta; la próxima lectura lo vuelve a calcular.
+    if current_data_version() != version:
+        invalidate_cycle_snapshots(d1)
+        db.session.commit()
+        return None, filas
+    return summary, filas
+
+def cycle_rows(d1, d2):
+    """Como _live_cycle_rows, pero los ciclos cerrados salen de su snapshot."""
+    if not cycle_closed(d2):
+        return _live_cycle_rows(d1, d2)
+    if db.session.get(CycleSummary, d1) is None:
+        try:
+            # un ciclo vacío (p.ej. ?y= anterior a los datos) no se guarda: nada que congelar
+            return snapshot_cycle(d1, d2, guardar_vacio=False)[1]
+        except IntegrityError:
+            db.session.rollback()  # otro worker lo guardó a la vez
+    return (db.session.query(Category.id, Category.nombre, Category.tipo,
+                             CycleAggregate.fecha, CycleAggregate.total)
+            .join(Category, CycleAggregate.category_id == Category.id)
+            .filter(CycleAggregate.cycle_start == d1)
+            .all())
+
+def cycle_category_totals(d1, d2):
+    """Una fila (category_id, tipo, total) por categoría del ciclo, sin desglose por día."""
+    if cycle_closed(d2) and db.session.get(CycleSummary, d1) is not None:
+        return (db.session.query(Category.id, Category.tipo, func.sum(CycleAggregate.total))
+                .join(Category, CycleAggregate.category_id == Category.id)
+                .filter(CycleAggregate.cycle_start == d1)
+                .group_by(Category.id)
+                .all())
+    return (db.session.query(Category.id, Category.tipo, func.sum(cast(Transaction.importe, db.Float)))
+            .join(Category, Transaction.category_id == Category.id)
+            .filter(Transaction.fecha >= d1, Transaction.fecha < d2)
+            .group_by(Category.id)
+            .all())
+
+def invalidate_cycle_snapshots(*fechas):
+    """Descarta los snapshots de los ciclos que contienen esas fechas; va en la misma transacción que la escritura."""
+    starts = {d1 for d1, d2 in (cycle_bounds(f) for f in fechas if f) if cycle_closed(d2)}
+    if not starts:
+        return
+    CycleAggregate.query.filter(CycleAggregate.cycle_start.in_(starts)).delete(synchronize_session=False)
+    CycleSummary.query.filter(CycleSummary.cycle_start.in_(starts)).delete(synchronize_session=False)
+
+@app.cli.command('aggregate-cycle')
+@click.option('--date', 'fecha', required=True, help='Cualquier fecha del ciclo (YYYY-MM-DD)')
+def aggregate_cycle_command(fecha):
+    """(Re)genera el snapshot del ciclo que contiene la fecha dada."""
+    ref = parse_date(fecha)
+    if ref is None:
+        raise click.BadParameter('Fecha inválida', param_hint='--date')
+    d1, d2 = cycle_bounds(ref)
+    if not cycle_closed(d2):
+        raise click.ClickException('El ciclo aún no está cerrado')
+    invalidate_cycle_snapshots(d1)
+    summary, _ = snapshot_cycle(d1, d2)
+    if summary is None:
+        raise click.ClickException('Hubo escrituras durante el cálculo; vuelve a intentarlo')
+    click.echo(f'Ciclo {d1.isoformat()}: ingresos {summary.ingresos:.2f}, gastos {summary.gastos:.2f}')
 
 # --------- RUTAS ---------
 @app.route('/')
@@ -127,90 +520,107 @@ def home():
 def resumen():
     y_arg, m_arg = request.args.get('y'), request.args.get('m')
     ref = date(int(y_arg), int(m_arg), CYCLE_START_DAY) if y_arg and m_arg else date.today()
-
     d1, d2 = cycle_bounds(ref, CYCLE_START_DAY)
+
+    # Con mensajes flash pendientes (o en debug) la página no es reutilizable
+    if app.debug or session.get('_flashes'):
+        return _render_resumen(d1, d2)
+
+    # la versión se lee antes de renderizar: el HTML es como mínimo de esa versión, y si
+    # entretanto alguien escribe, la siguiente petición ya ve otra versión y lo rehace
+    version = current_data_version()
+    cached = _resumen_cache.get(d1)
+    if cached is None or cached[0] != version:
+        cached = (version, f"{_cache_epoch}-{version}-{d1.isoformat()}", _render_resumen(d1, d2))
+        _resumen_cache[d1] = cached
+        if len(_resumen_cache) > RESUMEN_CACHE_MAX:
+            _resumen_cache.popitem(last=False)
+    elif d1 in _resumen_cache:  # otro hilo puede haberlo expulsado entretanto
+        _resumen_cache.move_to_end(d1)
+    _, etag, html = cached
+
+    resp = make_response(html)
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True  # el navegador revalida siempre con If-None-Match
+    return resp.make_conditional(request)
+
+@no_autoflush
+def _render_resumen(d1, d2):
     fin_inclusivo = d2 - timedelta(days=1)
 
-    # Transacciones del ciclo
-    tx = Transaction.query.filter(Transaction.fecha >= d1, Transaction.fecha < d2).all()
+    # Totales del ciclo agregados en SQL (o desde el snapshot si está cerrado): una fila por (categoría, día)
+    filas = cycle_rows(d1, d2)
+
+    n_days = (d2 - d1).days
+    dias = [d1 + timedelta(days=i) for i in range(n_days)]
+    dia_idx = {d: i for i, d in enumerate(dias)}  # fecha -> posición en las series diarias
+    labels_days = [d.strftime("%d/%m") for d in dias]
+
+    ingresos, gastos = 0.0, 0.0
+    por_cat = defaultdict(float)        # (nombre, tipo) -> total (para tabla)
+    gasto_por_cat = defaultdict(float)  # nombre -> gastado
+    spent_by_cat = defaultdict(float)   # category_id -> gastado
+    daily_income  = [0.0] * n_days
+    daily_expense = [0.0] * n_days
+    for cat_id, nombre, tipo, fecha, total in filas:
+        total = total or 0.0
+        idx = dia_idx[fecha]  # el filtro del ciclo garantiza que la fecha está en rango
+        por_cat[(nombre, tipo)] += total
+        if tipo == 'ingreso':  # tipo solo puede ser 'ingreso' o 'gasto'
+            ingresos += total
+            daily_income[idx] += total
+        else:
+            gastos += total
+            gasto_por_cat[nombre] += total
+            spent_by_cat[cat_id] += total
+            daily_expense[idx] += total
 
     # KPIs
-    ingresos = sum(float(t.importe) for t in tx if t.category and (t.category.tipo or '').strip().lower() == 'ingreso')
-    gastos   = sum(float(t.importe) for t in tx if t.category and (t.category.tipo or '').strip().lower() == 'gasto')
-    balance  = ingresos - gastos
-
-    # Saldos por cuenta
-    cuentas = Account.query.order_by(Account.nombre).all()
-    saldos = []
-    for c in cuentas:
-        movs = Transaction.query.filter_by(account_id=c.id).all()
-        total_movs = sum(float(t.signed_amount) for t in movs)
-        saldos.append({'cuenta': c, 'saldo': float(c.saldo_inicial) + total_movs})
-
-    # Totales por categoría (para tabla)
-    por_cat = {}
-    for t in tx:
-        key = (t.category.nombre if t.category else 'Sin categoría',
-               (t.category.tipo if t.category else 'gasto'))
-        por_cat[key] = por_cat.get(key, 0.0) + float(t.importe)
+    balance = ingresos - gastos
+
+    # Saldos por cuenta: cuentas + suma con signo de sus movimientos, en una sola consulta
+    signed = cast(Transaction.signed_amount, db.Float)
+    movs = (db.session.query(Transaction.account_id.label('account_id'), func.sum(signed).label('total'))
+            .join(Category, Transaction.category_id == Category.id)
+            .group_by(Transaction.account_id)
+            .subquery())
+    saldo = func.coalesce(cast(Account.saldo_inicial, db.Float), 0.0) + func.coalesce(movs.c.total, 0.0)
+    cuentas = (db.session.query(Account, saldo)
+               .outerjoin(movs, movs.c.account_id == Account.id)
+               .order_by(Account.nombre)
+               .all())
+    saldos = [{'cuenta': c, 'saldo': total} for c, total in cuentas]
 
     # ---------- Datos para los charts ----------
 
     # 1) Gasto por categoría (descendente)
-    gasto_por_cat = {}
-    for t in tx:
-        if t.category and (t.category.tipo or '').strip().lower() == 'gasto':
-            gasto_por_cat[t.category.nombre] = gasto_por_cat.get(t.category.nombre, 0.0) + float(t.importe)
-    gasto_rank = sorted(gasto_por_cat.items(), key=lambda x: x[1], reverse=True)
+    gasto_rank = sorted(gasto_por_cat.items(), key=itemgetter(1), reverse=True)
     labels_cat_desc = [name for name, _ in gasto_rank]
     values_cat_desc = [val for _, val in gasto_rank]
 
     # 2) Presupuesto vs Gastado (por categoría)
-    budget = Budget.query.filter_by(cycle_start=d1).first()
-    budget_map = {}
-    if budget:
-        for bl in budget.lines:
-            if bl.category and (bl.category.tipo or '').strip().lower() == 'gasto':
-                budget_map[bl.category_id] = float(bl.amount or 0)
-
-    # gastado real por categoría en el ciclo
-    spent_by_cat = {}
-    for t in tx:
-        if t.category and (t.category.tipo or '').strip().lower() == 'gasto':
-            spent_by_cat[t.category_id] = spent_by_cat.get(t.category_id, 0.0) + float(t.importe)
-
-    cats_gasto = Category.query.filter(Category.tipo == 'gasto').order_by(Category.nombre).all()
-    labels_bv   = [c.nombre for c in cats_gasto]
-    data_budget = [float(budget_map.get(c.id, 0.0)) for c in cats_gasto]
-    data_spent  = [float(spent_by_cat.get(c.id, 0.0)) for c in cats_gasto]
+    cats_gasto = get_gasto_categories()
+    gasto_ids = {c.id for c in cats_gasto}
 
-    # 3) Ingresos vs Gastos (acumulado por día)
-    n_days = (d2 - d1).days
-    labels_days = [(d1 + timedelta(days=i)).strftime("%d/%m") for i in range(n_days)]
-    daily_income  = [0.0] * n_days
-    daily_expense = [0.0] * n_days
-    for t in tx:
-        idx = (t.fecha - d1).days
-        if 0 <= idx < n_days:
-            if t.category and (t.category.tipo or '').strip().lower() == 'ingreso':
-                daily_income[idx] += float(t.importe)
-            else:
-                daily_expense[idx] += float(t.importe)
+    # líneas del presupuesto del ciclo en una sola consulta, sin cargar Budget ni sus líneas
+    lineas = (db.session.query(BudgetLine.category_id, cast(BudgetLine.amount, db.Float))
+              .join(Budget, BudgetLine.budget_id == Budget.id)
+              .filter(Budget.cycle_start == d1)
+              .all())
+    budget_map = {cat_id: amount or 0.0 for cat_id, amount in lineas if cat_id in gasto_ids}
 
-    def acumulada(arr):
-        out, s = [], 0.0
-        for v in arr:
-            s += float(v)
-            out.append(round(s, 2))
-        return out
+    labels_bv   = [c.nombre for c in cats_gasto]
+    data_budget = [budget_map.get(c.id, 0.0) for c in cats_gasto]
+    data_spent  = [spent_by_cat.get(c.id, 0.0) for c in cats_gasto]
 
-    series_ingresos = acumulada(daily_income)
-    series_gastos   = acumulada(daily_expense)
+    # 3) Ingresos vs Gastos (acumulado por día)
+    series_ingresos = [round(v, 2) for v in accumulate(daily_income)]
+    series_gastos   = [round(v, 2) for v in accumulate(daily_expense)]
 
-    # Navegación de ciclos
-    prev_anchor, next_anchor = d1 - timedelta(days=1), d2
-    prev_y, prev_m = prev_anchor.year, prev_anchor.month
-    next_y, next_m = next_anchor.year, next_anchor.month
+    # Navegación de ciclos: y/m identifican el mes en que empieza el ciclo
+    prev_d1, _ = cycle_bounds(d1 - timedelta(days=1), CYCLE_START_DAY)
+    prev_y, prev_m = prev_d1.year, prev_d1.month
+    next_y, next_m = d2.year, d2.month
 
     return render_template(
         'resumen.html',
@@ -226,8 +636,13 @@ def resumen():
 
 # ---- Transacciones ----
 @app.route('/transacciones')
+@no_autoflush
 def transactions_index():
-    q = Transaction.query
+    loaders = [selectinload(Transaction.account), selectinload(Transaction.category)]
+    if app.debug:
+        # en desarrollo, cualquier lazy load desde la plantilla revienta en vez de lanzar N SELECTs
+        loaders.append(raiseload('*'))
+    q = Transaction.query.options(*loaders)
     fd = parse_date(request.args.get('desde',''), None)
     fh = parse_date(request.args.get('hasta',''), None)
 
@@ -246,14 +661,45 @@ def transactions_index():
     if category_id: q = q.filter_by(category_id=category_id)
 
     texto = (request.args.get('q') or '').strip()
-    if texto: q = q.filter(Transaction.concepto.ilike(f"%{texto}%"))
+    if texto and tx_fts_enabled:
+        coincidencias = (text("SELECT rowid FROM tx_fts WHERE concepto LIKE :patron")
+                         .bindparams(patron=f"%{texto}%")
+                         .columns(column('rowid', db.Integer)))
+        q = q.filter(Transaction.id.in_(coincidencias))
+    elif texto:
+        q = q.filter(Transaction.concepto.ilike(f"%{texto}%"))
 
-    items = q.order_by(Transaction.fecha.desc(), Transaction.id.desc()).all()
-    accounts = Account.query.order_by(Account.nombre).all()
-    categories = Category.query.order_by(Category.tipo.desc(), Category.nombre).all()
+    # Paginación por cursor (fecha, id): cada página es un rango del índice, sin OFFSET ni COUNT
+    clave = tuple_(Transaction.fecha, Transaction.id)
+    after_fecha, after_id = parse_date(request.args.get('after_fecha') or ''), request.args.get('after_id', type=int)
+    before_fecha, before_id = parse_date(request.args.get('before_fecha') or ''), request.args.get('before_id', type=int)
+    if before_fecha and before_id is not None:
+        # hacia las más recientes: se recorre en orden ascendente y se invierte
+        filas = (q.filter(clave > tuple_(before_fecha, before_id))
+                  .order_by(Transaction.fecha, Transaction.id)
+                  .limit(TX_PER_PAGE + 1).all())
+        hay_recientes, hay_antiguas = len(filas) > TX_PER_PAGE, True
+        items = filas[:TX_PER_PAGE][::-1]
+    else:
+        if after_fecha and after_id is not None:
+            q = q.filter(clave < tuple_(after_fecha, after_id))
+        filas = (q.order_by(Transaction.fecha.desc(), Transaction.id.desc())
+                  .limit(TX_PER_PAGE + 1).all())
+        hay_recientes, hay_antiguas = bool(after_fecha and after_id is not None), len(filas) > TX_PER_PAGE
+        items = filas[:TX_PER_PAGE]
+    # enlaces de página: los filtros actuales más el cursor de la fila del borde
+    filtros = {k: v for k, v in request.args.items()
+               if k not in ('after_fecha', 'after_id', 'before_fecha', 'before_id')}
+    cursor_recientes = (dict(filtros, before_fecha=items[0].fecha.isoformat(), before_id=items[0].id)
+                        if hay_recientes and items else None)
+    cursor_antiguas = (dict(filtros, after_fecha=items[-1].fecha.isoformat(), after_id=items[-1].id)
+                       if hay_antiguas and items else None)
+    accounts = get_accounts()
+    categories = get_categories()
 
     return render_template('transactions_index.html',
-        items=items, accounts=accounts, categories=categories,
+        items=items, cursor_recientes=cursor_recientes, cursor_antiguas=cursor_antiguas,
+        accounts=accounts, categories=categories,
         desde_value=fd.strftime('%Y-%m-%d') if fd else '',
         hasta_value=fh.strftime('%Y-%m-%d') if fh else '',
         account_selected=str(account_id),
@@ -262,10 +708,14 @@ def transactions_index():
         default_cycle=default_cycle
     )
 
+def render_tx_form(**ctx):
+    """Formulario de transacción: los desplegables solo se piden cuando de verdad se pinta."""
+    with db.session.no_autoflush:  # al editar con errores, la transacción tiene cambios sin validar
+        return render_template('transactions_form.html',
+                               accounts=get_accounts(), categories=get_categories(), **ctx)
+
 @app.route('/transacciones/nueva', methods=['GET','POST'])
 def transactions_new():
-    accounts = Account.query.order_by(Account.nombre).all()
-    categories = Category.query.order_by(Category.tipo.desc(), Category.nombre).all()
     if request.method == 'POST':
         fecha = parse_date(request.form.get('fecha'), date.today())
         concepto = request.form.get('concepto','').strip()
@@ -276,29 +726,35 @@ def transactions_new():
 
         if not concepto:
             flash('El concepto es obligatorio', 'error')
-            return render_template('transactions_form.html', accounts=accounts, categories=categories)
+            return render_tx_form()
         try:
             imp = Decimal(importe_s)
             if imp <= 0: raise ValueError()
         except Exception:
             flash('Importe inválido', 'error')
-            return render_template('transactions_form.html', accounts=accounts, categories=categories)
+            return render_tx_form()
 
         t = Transaction(fecha=fecha, concepto=concepto, importe=imp,
                         account_id=account_id, category_id=category_id, nota=nota)
-        db.session.add(t); db.session.commit()
+        db.session.add(t)
+        try:
+            invalidate_cycle_snapshots(fecha)
+            db.session.commit()
+        except IntegrityError:  # FK: cuenta o categoría borrada mientras el formulario estaba abierto
+            db.session.rollback()
+            flash('La cuenta o la categoría ya no existe', 'error')
+            return render_tx_form()
         flash('Transacción creada', 'ok')
         return redirect(url_for('transactions_index'))
 
-    return render_template('transactions_form.html', accounts=accounts, categories=categories)
+    return render_tx_form()
 
 @app.route('/transacciones/<int:tx_id>/editar', methods=['GET','POST'])
 def transactions_edit(tx_id):
     t = Transaction.query.get_or_404(tx_id)
-    accounts = Account.query.order_by(Account.nombre).all()
-    categories = Category.query.order_by(Category.tipo.desc(), Category.nombre).all()
 
     if request.method == 'POST':
+        fecha_anterior = t.fecha
         t.fecha = parse_date(request.form.get('fecha'), t.fecha)
         t.concepto = request.form.get('concepto','').strip()
         t.importe = Decimal(request.form.get('importe','0').replace(',', '.'))
@@ -307,17 +763,34 @@ def transactions_edit(tx_id):
         t.nota = request.form.get('nota','').strip()
         if not t.concepto or t.importe <= 0:
             flash('Revisa concepto e importe', 'error')
-            return render_template('transactions_form.html', accounts=accounts, categories=categories, item=t, modo='edit')
-        db.session.commit()
+            return render_tx_form(item=t, modo='edit')
+        try:
+            invalidate_cycle_snapshots(fecha_anterior, t.fecha)
+            db.session.commit()
+        except IntegrityError:  # FK: cuenta o categoría borrada mientras el formulario estaba abierto
+            db.session.rollback()
+            flash('La cuenta o la categoría ya no existe', 'error')
+            return redirect(url_for('transactions_edit', tx_id=tx_id))
         flash('Transacción actualizada', 'ok')
         return redirect(url_for('transactions_index'))
 
-    return render_template('transactions_form.html', accounts=accounts, categories=categories, item=t, modo='edit')
+    return render_tx_form(item=t, modo='edit')
 
 @app.route('/transacciones/<int:tx_id>/eliminar', methods=['POST'])
 def transactions_delete(tx_id):
-    t = Transaction.query.get_or_404(tx_id)
-    db.session.delete(t); db.session.commit()
+    # un solo DELETE; RETURNING da la fecha para invalidar el snapshot de su ciclo.
+    # SQLite < 3.35 no soporta RETURNING: ahí se lee la fecha antes del DELETE.
+    stmt = delete(Transaction).where(Transaction.id == tx_id).execution_options(synchronize_session=False)
+    if db.engine.dialect.delete_returning:
+        fecha = db.session.execute(stmt.returning(Transaction.fecha)).scalar_one_or_none()
+    else:
+        fecha = db.session.query(Transaction.fecha).filter(Transaction.id == tx_id).scalar()
+        if fecha is not None:
+            db.session.execute(stmt)
+    if fecha is None:
+        abort(404)
+    invalidate_cycle_snapshots(fecha)
+    db.session.commit()
     flash('Transacción eliminada', 'ok')
     return redirect(url_for('transactions_index'))
 
@@ -326,7 +799,7 @@ def transactions_delete(tx_id):
 def categories_index():
     if request.method == 'POST':
         nombre = request.form.get('nombre','').strip()
-        tipo = request.form.get('tipo','gasto')
+        tipo = request.form.get('tipo','gasto').strip().lower()
         if not nombre:
             flash('El nombre es obligatorio', 'error')
         elif tipo not in ('ingreso','gasto'):
@@ -335,22 +808,27 @@ def categories_index():
             try:
                 db.session.add(Category(nombre=nombre, tipo=tipo))
                 db.session.commit()
+                bump_catalog_version()
                 flash('Categoría creada', 'ok')
             except Exception:
                 db.session.rollback()
                 flash('No se pudo crear (¿nombre duplicado?)', 'error')
         return redirect(url_for('categories_index'))
 
-    cats = Category.query.order_by(Category.tipo.desc(), Category.nombre).all()
-    return render_template('categories_index.html', categories=cats)
+    # sin caché: tras crear o borrar, la redirección puede caer en otro worker y debe ver el cambio
+    return render_template('categories_index.html', categories=list_categories())
 
 @app.route('/categorias/<int:cat_id>/eliminar', methods=['POST'])
 def category_delete(cat_id):
     c = Category.query.get_or_404(cat_id)
-    if c.transactions:
+    # basta con una fila: no hace falta cargar todas las transacciones de la categoría
+    if db.session.query(Transaction.id).filter_by(category_id=c.id).first() is not None:
         flash('No se puede eliminar: tiene transacciones', 'error')
         return redirect(url_for('categories_index'))
+    # con foreign_keys=ON las líneas de presupuesto de la categoría bloquearían el borrado
+    BudgetLine.query.filter_by(category_id=c.id).delete(synchronize_session=False)
     db.session.delete(c); db.session.commit()
+    bump_catalog_version()
     flash('Categoría eliminada', 'ok')
     return redirect(url_for('categories_index'))
 
@@ -370,25 +848,124 @@ def accounts_index():
             try:
                 db.session.add(Account(nombre=nombre, saldo_inicial=s))
                 db.session.commit()
+                bump_catalog_version()
                 flash('Cuenta creada', 'ok')
             except Exception:
                 db.session.rollback()
                 flash('No se pudo crear (¿nombre duplicado?)', 'error')
         return redirect(url_for('accounts_index'))
 
-    cuentas = Account.query.order_by(Account.nombre).all()
-    return render_template('accounts_index.html', accounts=cuentas)
+    with db.session.no_autoflush:
+        cuentas = Account.query.order_by(Account.nombre).all()
+        return render_template('accounts_index.html', accounts=cuentas)
 
 @app.route('/cuentas/<int:acc_id>/eliminar', methods=['POST'])
 def accounts_delete(acc_id):
     a = Account.query.get_or_404(acc_id)
-    if a.transactions:
+    if db.session.query(Transaction.id).filter_by(account_id=a.id).first() is not None:
         flash('No se puede eliminar: tiene transacciones', 'error')
         return redirect(url_for('accounts_index'))
     db.session.delete(a); db.session.commit()
+    bump_catalog_version()
     flash('Cuenta eliminada', 'ok')
     return redirect(url_for('accounts_index'))
 
+# ---- Presupuesto ----
+@app.route('/presupuesto', methods=['GET','POST'])
+def budget_index():
+    src = request.form if request.method == 'POST' else request.args
+    y_arg, m_arg = src.get('y'), src.get('m')
+    ref = date(int(y_arg), int(m_arg), CYCLE_START_DAY) if y_arg and m_arg else date.today()
+    d1, d2 = cycle_bounds(ref, CYCLE_START_DAY)
+    gasto_cats = get_gasto_categories()
+
+    if request.method == 'POST':
+        campos = {'income_estimated': 'income_estimated'}
+        campos.update({c.id: f'cat_{c.id}' for c in gasto_cats})
+        importes = {}
+        for clave, campo in campos.items():
+            valor = request.form.get(campo)
+            if valor is None:
+                continue  # campo ausente: se conserva lo guardado
+            try:
+                importes[clave] = Decimal((valor.strip() or '0').replace(',', '.'))
+                if importes[clave] < 0: raise ValueError()
+            except Exception:
+                flash('Importe inválido', 'error')
+                return redirect(url_for('budget_index', y=d1.year, m=d1.month))
+
+        budget = Budget.query.filter_by(cycle_start=d1).first()
+        if budget is None:
+            budget = Budget(cycle_start=d1)
+            db.session.add(budget)
+        if 'income_estimated' in importes:
+            budget.income_estimated = importes.pop('income_estimated')
+        db.session.flush()  # budget.id para las líneas nuevas
+
+        # una sola sentencia por tipo de operación en vez de un add/delete por categoría
+        actuales = {cat_id: (line_id, amount) for line_id, cat_id, amount in
+                    db.session.query(BudgetLine.id, BudgetLine.category_id, BudgetLine.amount)
+                    .filter(BudgetLine.budget_id == budget.id)}
+        to_insert, to_update, to_delete = [], [], []
+        for cat_id, amount in importes.items():
+            line_id, anterior = actuales.get(cat_id, (None, None))
+            if line_id is None:
+                if amount > 0:
+                    to_insert.append({'budget_id': budget.id, 'category_id': cat_id, 'amount': amount})
+            elif amount == 0:
+                to_delete.append(line_id)
+            elif amount != anterior:
+                to_update.append({'id': line_id, 'amount': amount})
+        try:
+            if to_insert:
+                db.session.execute(insert(BudgetLine), to_insert)  # executemany / insertmanyvalues
+            if to_update:
+                db.session.execute(update(BudgetLine), to_update)  # UPDATE ... WHERE id = ? por lotes
+            if to_delete:
+                BudgetLine.query.filter(BudgetLine.id.in_(to_delete)).delete(synchronize_session=False)
+            db.session.commit()
+        except IntegrityError:  # FK: categoría borrada que aún sale en el catálogo cacheado
+            db.session.rollback()
+            flash('No se pudo guardar: alguna categoría ya no existe', 'error')
+            return redirect(url_for('budget_index', y=d1.year, m=d1.month))
+        flash('Presupuesto guardado', 'ok')
+        return redirect(url_for('budget_index', y=d1.year, m=d1.month))
+
+    with db.session.no_autoflush:
+        # importes ya como float desde SQL, sin cargar Budget ni BudgetLine
+        income_estimated = (db.session.query(cast(Budget.income_estimated, db.Float))
+                            .filter(Budget.cycle_start == d1)
+                            .scalar()) or 0.0
+        line_by_cat = dict(db.session.query(BudgetLine.category_id, cast(BudgetLine.amount, db.Float))
+                           .join(Budget, BudgetLine.budget_id == Budget.id)
+                           .filter(Budget.cycle_start == d1)
+                           .all())
+
+        # gastado por categoría e ingresos reales: una fila por categoría con movimientos
+        # (importes NOT NULL: ni las sumas ni las líneas pueden venir a NULL)
+        spent_by_cat = {}
+        total_income_real = 0.0
+        for cat_id, tipo, total in cycle_category_totals(d1, d2):
+            if tipo == 'ingreso':
+                total_income_real += total
+            else:
+                spent_by_cat[cat_id] = total
+
+        total_budget = sum(line_by_cat.get(c.id, 0.0) for c in gasto_cats)
+        total_spent = sum(spent_by_cat.get(c.id, 0.0) for c in gasto_cats)
+
+        # y/m identifican el mes en que empieza el ciclo
+        prev_d1, _ = cycle_bounds(d1 - timedelta(days=1), CYCLE_START_DAY)
+        return render_template('budget_index.html',
+            d1=d1, fin_inclusivo=d2 - timedelta(days=1), y=d1.year, m=d1.month,
+            income_estimated=income_estimated,
+            prev_y=prev_d1.year, prev_m=prev_d1.month,
+            next_y=d2.year, next_m=d2.month,
+            gasto_cats=gasto_cats, line_by_cat=line_by_cat, spent_by_cat=spent_by_cat,
+            total_budget=total_budget, total_spent=total_spent,
+            total_income_real=total_income_real
+        )
+
 # ---- OBJETIVOS ----
 @app.route('/objetivos', methods=['GET','POST'])
 def goals_index():
@@ -409,13 +986,24 @@ def goals_index():
         flash('Objetivo creado', 'ok')
         return redirect(url_for('goals_index'))
 
-    goals = Goal.query.order_by(Goal.fecha_limite.is_(None), Goal.fecha_limite).all()
-    return render_template('goals_index.html', goals=goals)
+    with db.session.no_autoflush:
+        goals = (Goal.query
+                 .options(selectinload(Goal.aportes))  # la plantilla lista los aportes de cada objetivo
+                 .order_by(Goal.fecha_limite.asc().nulls_last())  # sin fecha al final
+                 .all())
+        return render_template('goals_index.html', goals=goals)
 
 @app.route('/objetivos/<int:goal_id>/eliminar', methods=['POST'])
 def goals_delete(goal_id):
-    g = Goal.query.get_or_404(goal_id)
-    db.session.delete(g); db.session.commit()
+    # sin cargar el objetivo: primero sus aportes (foreign_keys=ON) y luego él
+    db.session.execute(delete(GoalContribution).where(GoalContribution.goal_id == goal_id)
+                       .execution_options(synchronize_session=False))
+    res = db.session.execute(delete(Goal).where(Goal.id == goal_id)
+                             .execution_options(synchronize_session=False))
+    if not res.rowcount:
+        db.session.rollback()
+        abort(404)
+    db.session.commit()
     flash('Objetivo eliminado', 'ok')
     return redirect(url_for('goals_index'))
 
@@ -439,10 +1027,15 @@ def goals_add_contribution(goal_id):
 
 @app.route('/objetivos/<int:goal_id>/aporte/<int:aid>/eliminar', methods=['POST'])
 def goals_delete_contribution(goal_id, aid):
-    a = GoalContribution.query.get_or_404(aid)
-    db.session.delete(a); db.session.commit()
+    res = db.session.execute(delete(GoalContribution)
+                             .where(GoalContribution.id == aid, GoalContribution.goal_id == goal_id)
+                             .execution_options(synchronize_session=False))
+    if not res.rowcount:
+        abort(404)
+    db.session.commit()
     flash('Aporte eliminado', 'ok')
     return redirect(url_for('goals_index'))
 
 if __name__ == "__main__":
-    app.run(debug=True, use_reloader=False)
+    # modo debug solo con FLASK_DEBUG=1
+    app.run(use_reloader=False)